@@ -0,0 +1,118 @@
+/*
+ * Expansion of packed 24-bit little-endian two's complement samples (the
+ * format ActiView streams over TCP) to int32.
+ *
+ * Licensed under MIT
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+/* The SSSE3 kernel is compiled for that instruction set only (via the target
+ * attribute) rather than for the whole module, and is only used if the CPU
+ * supports it at runtime. Otherwise, the scalar loop handles everything. */
+#if (defined(__GNUC__) || defined(__clang__)) && \
+    (defined(__x86_64__) || defined(__i386__))
+#define HAVE_SSSE3_KERNEL
+#include <tmmintrin.h>
+
+static int use_ssse3 = 0;
+
+__attribute__((target("ssse3")))
+static Py_ssize_t
+unpack24_ssse3(const uint8_t *src, int32_t *dst, Py_ssize_t n_samples)
+{
+    Py_ssize_t i = 0;
+
+    /* Move each group of three bytes into the upper three bytes of a 32-bit
+     * lane (0x80 zeroes the low byte). The arithmetic right shift then drops
+     * the low byte and sign-extends. Each iteration loads 16 bytes but only
+     * consumes 12, so stop while at least 16 bytes remain and let the scalar
+     * loop finish the tail. Returns the number of samples handled. */
+    const __m128i mask = _mm_setr_epi8(
+        (char) 0x80, 0, 1, 2,
+        (char) 0x80, 3, 4, 5,
+        (char) 0x80, 6, 7, 8,
+        (char) 0x80, 9, 10, 11);
+    for (; i * 3 + 16 <= n_samples * 3; i += 4) {
+        __m128i v = _mm_loadu_si128((const __m128i *) (src + i * 3));
+        v = _mm_shuffle_epi8(v, mask);
+        v = _mm_srai_epi32(v, 8);
+        _mm_storeu_si128((__m128i *) (dst + i), v);
+    }
+    return i;
+}
+#endif
+
+
+static void
+unpack24_kernel(const uint8_t *src, int32_t *dst, Py_ssize_t n_samples)
+{
+    Py_ssize_t i = 0;
+
+#ifdef HAVE_SSSE3_KERNEL
+    if (use_ssse3)
+        i = unpack24_ssse3(src, dst, n_samples);
+#endif
+
+    for (; i < n_samples; i++) {
+        const uint8_t *p = src + i * 3;
+        int32_t v = (int32_t) ((uint32_t) p[0] | ((uint32_t) p[1] << 8) |
+                               ((uint32_t) p[2] << 16));
+        dst[i] = (v ^ 0x800000) - 0x800000;
+    }
+}
+
+
+static PyObject *
+unpack24(PyObject *self, PyObject *args)
+{
+    Py_buffer src, dst;
+    Py_ssize_t n_samples;
+
+    if (!PyArg_ParseTuple(args, "y*w*", &src, &dst))
+        return NULL;
+
+    n_samples = src.len / 3;
+    if (dst.len < n_samples * (Py_ssize_t) sizeof(int32_t)) {
+        PyErr_SetString(PyExc_ValueError, "Destination buffer is too small");
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&dst);
+        return NULL;
+    }
+
+    /* The buffers stay valid until released, so the kernel can run without
+     * the GIL while other threads (e.g., the receive thread) carry on. */
+    Py_BEGIN_ALLOW_THREADS
+    unpack24_kernel((const uint8_t *) src.buf, (int32_t *) dst.buf, n_samples);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&src);
+    PyBuffer_Release(&dst);
+    Py_RETURN_NONE;
+}
+
+
+static PyMethodDef unpack24_methods[] = {
+    {"unpack24", unpack24, METH_VARARGS,
+     "unpack24(src, dst)\n\n"
+     "Expand the packed 24-bit samples in src into the int32 buffer dst."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef unpack24_module = {
+    PyModuleDef_HEAD_INIT, "_unpack24", NULL, -1, unpack24_methods
+};
+
+
+PyMODINIT_FUNC
+PyInit__unpack24(void)
+{
+#ifdef HAVE_SSSE3_KERNEL
+    __builtin_cpu_init();
+    use_ssse3 = __builtin_cpu_supports("ssse3");
+#endif
+    return PyModule_Create(&unpack24_module);
+}
@@ -10,9 +10,38 @@ https://batchloaf.wordpress.com/2014/01/17/real-time-analysis-of-data-from-biose
 import logging
 log = logging.getLogger(__name__)
 
+from collections import namedtuple
+from functools import lru_cache, partial
+import queue
 import socket
+import sys
+import threading
+
 import numpy as np
 
+try:
+    from ._unpack24 import unpack24
+except ImportError:
+    unpack24 = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# Ask the kernel to fill the whole buffer in a single call where possible. The
+# semantics of MSG_WAITALL differ on Windows, so it's not used there.
+if sys.platform == 'win32':
+    _RECV_FLAGS = 0
+else:
+    _RECV_FLAGS = getattr(socket, 'MSG_WAITALL', 0)
+
+# How often (in seconds) the receive thread checks whether it has been asked to
+# stop while waiting for a free buffer. This is independent of the socket
+# timeout, which may be None.
+_POLL_INTERVAL = 0.1
+
 
 SPEED_MODE = {
     0: 2048,
@@ -26,12 +55,14 @@ SPEED_MODE = {
 }
 
 
-def is_set(x, bit):
-    # Parentheses are not needed because of operator precedence rules, but help
-    # make the code more readable.
-    return bool((x & (1 << bit)) != 0)
+#: Status bits decoded from a single value of the trigger channel
+TriggerInfo = namedtuple('TriggerInfo', [
+    'trigger', 'cms_in_range', 'low_battery', 'ActiveMK2', 'speed_mode',
+    'new_epoch',
+])
 
 
+@lru_cache(maxsize=1024)
 def decode_trigger(x):
     '''
     Details
@@ -47,26 +78,101 @@ def decode_trigger(x):
     Bit 21 Speed bit 3
     Bit 22 High when battery is low
     Bit 23 (MSB) High if ActiveTwo MK2
+
+    Returns
+    -------
+    info : TriggerInfo
+        Named tuple with the decoded fields. Use `info._asdict()` if a
+        dictionary is needed. The sampling rate for the speed mode can be
+        looked up in `SPEED_MODE`.
+
+    Notes
+    -----
+    Trigger values tend to repeat for long stretches, so results are cached.
     '''
-    speed_mode = \
-        (int(is_set(x, 17)) << 0) + \
-        (int(is_set(x, 18)) << 1) + \
-        (int(is_set(x, 19)) << 2) + \
-        (int(is_set(x, 21)) << 3)
+    # Bits 17-19 map to speed bits 0-2 and bit 21 maps to speed bit 3.
+    speed_mode = ((x >> 17) & 0x7) | ((x >> 18) & 0x8)
+    return TriggerInfo(
+        trigger=int(x & 0xFFFF),
+        cms_in_range=bool((x >> 20) & 1),
+        low_battery=bool((x >> 22) & 1),
+        ActiveMK2=bool((x >> 23) & 1),
+        speed_mode=int(speed_mode),
+        new_epoch=bool((x >> 16) & 1),
+    )
+
+
+def decode_trigger_array(x):
+    '''
+    Vectorized version of `decode_trigger` for an entire trigger channel
 
-    trigger = 0b1111111111111111
+    Parameters
+    ----------
+    x : array of int
+        Values from the trigger channel.
 
+    Returns
+    -------
+    info : dict of arrays
+        Same fields as `TriggerInfo`, each an array with the same shape as `x`.
+    '''
+    x = np.asarray(x)
     return {
-        'trigger': int(x & trigger),
-        'cms_in_range': is_set(x, 20),
-        'low_battery': is_set(x, 22),
-        'ActiveMK2': is_set(x, 23),
-        'speed_mode': speed_mode,
-        'new_epoch': is_set(x, 16),
-        #'fs': SPEED_MODE[speed_mode],
+        'trigger': x & 0xFFFF,
+        'cms_in_range': ((x >> 20) & 1).astype(bool),
+        'low_battery': ((x >> 22) & 1).astype(bool),
+        'ActiveMK2': ((x >> 23) & 1).astype(bool),
+        'speed_mode': ((x >> 17) & 0x7) | ((x >> 18) & 0x8),
+        'new_epoch': ((x >> 16) & 1).astype(bool),
     }
 
 
+def _decode24_numpy(data, out, n_channels, tcp_samples, scratch):
+    # Each sample arrives as three bytes, least significant byte first, with
+    # all channels for one time point packed together. Rather than unpacking
+    # the bytes, view the packet as little-endian int32 with a stride of three
+    # bytes, so each element holds one sample in its lower three bytes plus
+    # the first byte of the next sample. Shifting left by 8 discards that
+    # extra byte, and the arithmetic right shift by 8 then sign-extends the
+    # 24-bit two's complement value. The last element reads one byte past the
+    # packet, so `data` must have at least one byte of padding at the end.
+    samples = np.ndarray((tcp_samples, n_channels), dtype='<i4', buffer=data,
+                         strides=(n_channels * 3, 3))
+    np.left_shift(samples, 8, out=scratch)
+    scratch >>= 8
+    out[:] = scratch.T
+
+
+def _decode24_c(data, out, n_channels, tcp_samples, scratch):
+    # The C extension expands the packet into `scratch` (time x channel) using
+    # SIMD shuffles where available. It releases the GIL while doing so.
+    unpack24(data, scratch)
+    out[:] = scratch.T
+
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False, nogil=True)
+    def _decode24_numba(data, out, n_channels, tcp_samples, scratch):
+        # Single pass over the packet directly into `out`, so `scratch` is not
+        # needed. Runs without the GIL so it can overlap with the receive
+        # thread (or with other clients). Numba promotes the bytes to int64,
+        # so sign-extend with an xor/subtract rather than a shift pair (which
+        # would only work on an int32).
+        for m in range(tcp_samples):
+            for c in range(n_channels):
+                o = (m * n_channels + c) * 3
+                v = data[o] | (data[o+1] << 8) | (data[o+2] << 16)
+                out[c, m] = (v ^ 0x800000) - 0x800000
+
+
+if unpack24 is not None:
+    _decode24 = _decode24_c
+elif njit is not None:
+    _decode24 = _decode24_numba
+else:
+    _decode24 = _decode24_numpy
+
+
 class ActiveTwoClient:
     """
     Client for communicating with Biosemi ActiveTwo
@@ -77,11 +183,21 @@ class ActiveTwoClient:
     #: Number of channles
     #: Data packet size (default: 32 channels @ 512Hz)
 
+    __slots__ = (
+        'host', 'port', 'eeg_channels', 'ex_included', 'sensors_included',
+        'jazz_included', 'aib_included', 'trigger_included', 'socket_timeout',
+        'fs', 'combine_eeg_exg', 'receive_thread', 'sock', 'slices',
+        'n_channels', 'tcp_samples', 'buffer_size', '_scratch', '_net_bufs',
+        '_net_views', '_got', '_decoders', '_thread', '_stop', '_free',
+        '_filled',
+    )
+
     def __init__(self, host='127.0.0.1', port=8888, eeg_channels=32,
                  ex_included=False, sensors_included=False,
                  jazz_included=False, aib_included=False,
                  trigger_included=False, socket_timeout=0.25,
-                 fs=512, combine_eeg_exg=True):
+                 fs=512, combine_eeg_exg=True, receive_thread=False,
+                 tcp_samples=None):
         """
         Initialize connection and parameters of the signal
 
@@ -96,8 +212,32 @@ class ActiveTwoClient:
         combine_eeg_exg : bool
             If true, the EEG and EXG channels are combined into a single 2D
             array (with EXG stacked at the end).
+        receive_thread : bool
+            If true, packets are received on a background thread (started by
+            `connect`) while the previous packet is being decoded. Note that
+            the thread keeps pulling packets off the socket between calls to
+            `read`, so the next `read` starts with up to two packets that
+            arrived before it was called.
+        tcp_samples : {None, int}
+            Number of samples per channel to receive and decode in each block.
+            If None, this matches the packet size used by ActiView (128 samples
+            at 16384 Hz, scaled down with the decimation factor). Since the data
+            arrives as a continuous TCP stream, larger blocks can be used to
+            spread the per-block overhead over more samples. Note that `read`
+            rounds the requested duration up to a whole number of blocks.
         """
-        self.__dict__.update(locals())
+        self.host = host
+        self.port = port
+        self.eeg_channels = eeg_channels
+        self.ex_included = ex_included
+        self.sensors_included = sensors_included
+        self.jazz_included = jazz_included
+        self.aib_included = aib_included
+        self.trigger_included = trigger_included
+        self.socket_timeout = socket_timeout
+        self.fs = fs
+        self.combine_eeg_exg = combine_eeg_exg
+        self.receive_thread = receive_thread
 
         # Calculate number of TCP samples in array.
         if not (256 <= fs <= 16384):
@@ -105,7 +245,11 @@ class ActiveTwoClient:
         decimation_factor = 16384 / fs
         if int(decimation_factor) != decimation_factor:
             raise ValueError('Invalid sampling rate supplied')
-        self.tcp_samples = int(128 / decimation_factor)
+        if tcp_samples is None:
+            tcp_samples = int(128 / decimation_factor)
+        elif tcp_samples < 1 or int(tcp_samples) != tcp_samples:
+            raise ValueError('Invalid number of TCP samples supplied')
+        self.tcp_samples = int(tcp_samples)
 
         # Build a mapping of channel type to a Numpy slice that can be used to
         # segment the data that we read in. I use a little trick to enable
@@ -142,61 +286,117 @@ class ActiveTwoClient:
         self.slices = slices
         self.n_channels = n_channels
         self.buffer_size = self.n_channels * self.tcp_samples * 3
+        self._scratch = np.empty((self.tcp_samples, self.n_channels), dtype='<i4')
+
+        # Packets are received into persistent buffers rather than allocating
+        # a new bytes object for each packet. When receiving on a background
+        # thread, two buffers are used so that one can be filled while the
+        # other is decoded.
+        # Each buffer has one extra byte of padding at the end for the NumPy
+        # decoder (see `_decode24_numpy`) that is never received into.
+        n_buffers = 2 if receive_thread else 1
+        self._net_bufs = [bytearray(self.buffer_size + 1) for i in range(n_buffers)]
+        self._net_views = [memoryview(b)[:self.buffer_size] for b in self._net_bufs]
+        self._got = 0
+
+        # Everything the decoder needs other than the output slot is fixed for
+        # the lifetime of the client, so bind it once here.
+        self._decoders = [
+            partial(_decode24, np.frombuffer(b, dtype='uint8'),
+                    n_channels=self.n_channels, tcp_samples=self.tcp_samples,
+                    scratch=self._scratch)
+            for b in self._net_bufs
+        ]
+        self._thread = None
+
         m = 'ActiveTwoClient configured with %d channels at %f Hz'
         log.info(m, self.n_channels, self.fs)
         log.info('Expecting %d samples/chan', self.tcp_samples)
 
-        self._scale = np.array([256**1, 256**2, 256**3])
-        self._read = self._read_scale
-
-    def _read_scale(self, samples):
-        # This implements the approach used in the Matlab TCP example
-        data = self.sock.recv(self.buffer_size)
-        data = np.frombuffer(data, dtype='uint8').reshape((self.tcp_samples, self.n_channels, 3))
-        return np.sum(data * self._scale, axis=-1).T.astype('int32')
-
-    def _read_bitshift(self, samples):
-        # This is a tad bit slower in testing
-        signal_buffer = np.zeros((self.n_channels, self.tcp_samples), dtype='uint32')
-        data = self.sock.recv(self.buffer_size)
-
-        for m in range(self.tcp_samples):
-            # extract samples for each channel
-            for channel in range(self.n_channels):
-                offset = m * 3 * self.n_channels + (channel * 3)
-
-                # The 3 bytes of each sample arrive in reverse order
-                sample = \
-                    (data[offset+2] << 24) + \
-                    (data[offset+1] << 16) + \
-                    (data[offset] << 8)
-
-                # Store sample to signal buffer
-                signal_buffer[channel, m] = sample
-
-        return signal_buffer
-
-    def _read_bitshift(self, samples):
-        signal_buffer = np.zeros((self.n_channels, self.tcp_samples), dtype='uint32')
-        data = self.sock.recv(self.buffer_size)
-
-        for m in range(self.tcp_samples):
-            # extract samples for each channel
-            for channel in range(self.n_channels):
-                offset = m * 3 * self.n_channels + (channel * 3)
-
-                # The 3 bytes of each sample arrive in reverse order
-                sample = \
-                    (data[offset+2] << 16) + \
-                    (data[offset+1] << 8) + \
-                    (data[offset])
-
-                # Store sample to signal buffer
-                signal_buffer[channel, m] = sample
-
-        return signal_buffer
-
-    def read(self, duration):
+    def _recv(self, i=0, stop=None):
+        # TCP is a stream, so a single recv may return only part of a packet.
+        # MSG_WAITALL usually avoids this, but it can still return early (e.g.,
+        # on a signal, or because a socket with a timeout is non-blocking under
+        # the hood). Keep going until the full packet is in buffer `i`. If a
+        # `stop` event is provided, timeouts are retried until it is set.
+        # Otherwise, the timeout is raised, but the number of bytes already
+        # received is kept so that the next call picks up mid-packet rather
+        # than losing alignment with the stream.
+        view = self._net_views[i]
+        got = 0 if stop is not None else self._got
+        while got < self.buffer_size:
+            try:
+                n = self.sock.recv_into(view[got:], 0, _RECV_FLAGS)
+            except socket.timeout:
+                if stop is None:
+                    self._got = got
+                    raise
+                if stop.is_set():
+                    return False
+                continue
+            if n == 0:
+                raise ConnectionError('Connection closed by ActiView')
+            got += n
+        self._got = 0
+        return True
+
+    def _receive_loop(self):
+        # Runs on the background thread. Buffer indices cycle through the free
+        # queue (ready to be filled) and the filled queue (ready to be
+        # decoded). Any error is handed to the consumer via the filled queue.
+        try:
+            while not self._stop.is_set():
+                try:
+                    i = self._free.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if not self._recv(i, self._stop):
+                    break
+                self._filled.put(i)
+        except Exception as e:
+            self._filled.put(e)
+
+    def _start_receiver(self):
+        self._stop = threading.Event()
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for i in range(len(self._net_bufs)):
+            self._free.put(i)
+        self._thread = threading.Thread(target=self._receive_loop, daemon=True)
+        self._thread.start()
+
+    def _stop_receiver(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _read(self, out):
+        # Decode one packet into `out` (channel x time).
+        if self._thread is None:
+            self._recv()
+            self._decoders[0](out)
+            return
+
+        # Allow for the time it takes ActiView to produce a full block, which
+        # can be well over `socket_timeout` when `tcp_samples` is large. If the
+        # socket has no timeout, block as a plain recv would.
+        if self.socket_timeout is None:
+            timeout = None
+        else:
+            timeout = self.tcp_samples / self.fs + self.socket_timeout
+        try:
+            i = self._filled.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout('timed out') from None
+        if isinstance(i, Exception):
+            # The receive thread has exited, so leave the error in place for
+            # any subsequent reads until `disconnect` is called.
+            self._filled.put(i)
+            raise i
+        self._decoders[i](out)
+        self._free.put(i)
+
+    def read(self, duration, copy=False):
         """
         Read signal from EEG
 
@@ -205,37 +405,68 @@ class ActiveTwoClient:
         duration : float
             Duration, in seconds, to read. If duration is too long, then it
             seems the ActiView client will disconnect.
+        copy : bool
+            If true, each array in the result is an independent copy rather
+            than a view.
 
         Returns
         -------
-        signal : 2D array (channel x time)
-            Signal.
+        signal : dict of arrays
+            Signal for each channel type. Each signal channel type (e.g.,
+            'eeg') is a 2D float array (channel x time) scaled to volts. The
+            'trigger' entry, if present, is a 1D int32 array (time) of raw
+            status bits (see `decode_trigger`).
+
+            Unless `copy` is true, the arrays are views. The signal channel
+            types share a single scaled block allocated for this call, and
+            'trigger' is a view of the last row of the int32 (n_channels x
+            samples) block the packets were decoded into. Holding on to the
+            trigger array therefore keeps that entire block alive, not just
+            the trigger row. Pass `copy=True` if you need independent arrays.
         """
         total_samples = int(round(duration * self.fs))
 
+        # Packets are a fixed size, so the request is rounded up to a whole
+        # number of packets. Allocate the output once and have each packet
+        # decoded directly into its slot.
+        ts = self.tcp_samples
+        n_blocks = (total_samples + ts - 1) // ts
+        out = np.empty((self.n_channels, n_blocks * ts), dtype='int32')
+
         # The reader process will run until requested amount of data is collected
         samples = 0
-        data = []
-        while samples < total_samples:
+        for b in range(n_blocks):
             try:
-                data.append(self._read(samples))
-                samples += self.tcp_samples
-            except Exception as e:
-                log.exception(e)
+                self._read(out[:, b*ts:(b+1)*ts])
+                samples += ts
+            except socket.timeout:
+                m = 'Timed out after reading %d of %d samples'
+                log.warning(m, samples, n_blocks * ts)
                 break
 
-        if data:
-            data = np.concatenate(data, axis=-1)
+        # Only return what was actually read if we bailed out early.
+        data = out[:, :samples]
+
+        # Scale all of the signal channels in one pass so that each channel
+        # type in the result is a view into the same block. The trigger channel
+        # (always last) is a set of status bits (see `decode_trigger`), so it
+        # is not scaled. Instead, the sign extension is dropped in place.
+        if 'trigger' in self.slices:
+            signal = data[:-1] * 31.25e-9
+            trigger = data[-1]
+            trigger &= 0xFFFFFF
         else:
-            data = np.empty((self.n_channels, 0), dtype='int32')
+            signal = data * 31.25e-9
 
         result = {}
         for name, s in self.slices.items():
             if name != 'trigger':
                 # Convert to microvolts
-                result[name] = data[s] * 31.25e-9 / 256
+                result[name] = signal[s]
             else:
-                result[name] = data[s]
+                result[name] = trigger
+        if copy:
+            result = {k: v.copy() for k, v in result.items()}
         return result
 
     def connect(self):
@@ -243,10 +474,35 @@ class ActiveTwoClient:
         # program does not become unresponsive (on Windows even Ctrl+C can't
         # break a socket that's hung waiting for data).
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Ask the kernel for room to buffer about a second of data so that
+        # ActiView is not stalled while we are busy decoding. This needs to be
+        # set before connecting for the TCP window to be scaled accordingly.
+        # This is only a request. The OS may cap it (on Linux, at
+        # net.core.rmem_max, which is often only ~200 kB), and on Linux setting
+        # it also disables receive buffer autotuning. Check what we actually
+        # got so that an undersized buffer doesn't go unnoticed.
+        rcvbuf = max(self.fs * self.n_channels * 3, 1 << 20)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        actual = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if actual < rcvbuf:
+            m = 'Requested a %d byte receive buffer but the OS only allowed ' \
+                '%d bytes. Consider raising the OS limit (e.g., ' \
+                'net.core.rmem_max on Linux).'
+            log.warning(m, rcvbuf, actual)
         self.sock.connect((self.host, self.port))
         self.sock.settimeout(self.socket_timeout)
+        if self.receive_thread:
+            self._start_receiver()
 
     def disconnect(self):
-        # Important! Be sure this is called to properly shut down sockets.
+        # Important! Be sure this is called to properly shut down sockets. If
+        # the socket has no timeout, the receive thread may be blocked in
+        # recv_into, so shut down the socket (which wakes it up) before waiting
+        # for the thread to exit.
+        if self._thread is not None:
+            self._stop.set()
         self.sock.shutdown(socket.SHUT_RDWR)
+        if self._thread is not None:
+            self._stop_receiver()
         self.sock.close()
@@ -10,7 +10,7 @@ Licensed under MIT.
 
 
 import sys
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 from setuptools.command.test import test as TestCommand
 
 
@@ -29,6 +29,15 @@ class PyTest(TestCommand):
 
 version = "0.1"
 
+
+# Optional C accelerator for decoding the 24-bit samples. If it fails to build
+# (e.g., no compiler available), the pure NumPy decoder is used instead. The
+# SIMD kernel is selected at runtime based on the CPU, so no -m flags here.
+ext_modules = [
+    Extension('pyactivetwo._unpack24', ['pyactivetwo/_unpack24.c'],
+              optional=True),
+]
+
 setup(name="pyactivetwo",
       version=version,
       description="Python library for reading signal from BioSemi ActiveTwo EEG device",
@@ -43,10 +52,12 @@ setup(name="pyactivetwo",
       url="http://github.com/kuz/pyactivetwo",
       license="MIT",
       packages=find_packages(exclude=['examples', 'tests']),
+      ext_modules=ext_modules,
       include_package_data=True,
       zip_safe=False,
       tests_require=['pytest'],
       cmdclass={'test': PyTest},
       install_requires=['numpy'],
+      extras_require={'numba': ['numba']},
 )
 
@@ -0,0 +1,275 @@
+"""
+pyactivetwo: Tests for ActiveTwoClient.
+
+Licensed under MIT
+"""
+import socket
+import time
+
+import numpy as np
+import pytest
+
+from pyactivetwo import ActiveTwoClient
+from pyactivetwo.client import _decode24_numpy, decode_trigger, decode_trigger_array
+
+
+class FakeSocket:
+
+    def __init__(self, data, max_chunk=None):
+        self.data = data
+        self.offset = 0
+        self.max_chunk = max_chunk
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        n = nbytes or len(buffer)
+        if self.max_chunk is not None:
+            n = min(n, self.max_chunk)
+        chunk = self.data[self.offset:self.offset+n]
+        buffer[:len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+
+class SlowSocket(FakeSocket):
+    # Delivers at most one chunk per `delay` seconds, like a live stream.
+
+    def __init__(self, data, max_chunk, delay):
+        super().__init__(data, max_chunk)
+        self.delay = delay
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        time.sleep(self.delay)
+        return super().recv_into(buffer, nbytes, flags)
+
+
+class StallingSocket(FakeSocket):
+    # Raises a timeout once when reaching each offset in `stalls`.
+
+    def __init__(self, data, stalls):
+        super().__init__(data)
+        self.stalls = set(stalls)
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if self.offset in self.stalls:
+            self.stalls.remove(self.offset)
+            raise socket.timeout('timed out')
+        nbytes = nbytes or len(buffer)
+        # Don't read past the next stall.
+        for stall in self.stalls:
+            if stall > self.offset:
+                nbytes = min(nbytes, stall - self.offset)
+        return super().recv_into(buffer, nbytes, flags)
+
+
+def encode(signal):
+    # Inverse of the decoder. Signal is channel x time.
+    signal = np.asarray(signal, dtype='int32').T & 0xFFFFFF
+    raw = np.stack([signal & 0xFF, (signal >> 8) & 0xFF, signal >> 16], axis=-1)
+    return raw.astype('uint8').tobytes()
+
+
+def make_client(signal, max_chunk=None, **kwargs):
+    client = ActiveTwoClient(**kwargs)
+    client.sock = FakeSocket(encode(signal), max_chunk)
+    return client
+
+
+def test_read_sign_extension():
+    rng = np.random.default_rng(0)
+    signal = rng.integers(-2**23, 2**23, size=(5, 64), dtype='int32')
+    signal[:, 0] = [-2**23, -1, 0, 1, 2**23-1]
+    client = make_client(signal, eeg_channels=4, trigger_included=True, fs=1024)
+    assert client.n_channels == 5
+    assert client.tcp_samples == 8
+
+    result = client.read(64 / 1024)
+    np.testing.assert_allclose(result['eeg'], signal[:4] * 31.25e-9)
+    np.testing.assert_array_equal(result['trigger'], signal[-1] & 0xFFFFFF)
+
+
+def test_read_short_recv():
+    # Deliver the stream in chunks that straddle packet and sample boundaries.
+    rng = np.random.default_rng(1)
+    signal = rng.integers(-2**23, 2**23, size=(3, 32), dtype='int32')
+    client = make_client(signal, max_chunk=7, eeg_channels=3, fs=512)
+    result = client.read(32 / 512)
+    np.testing.assert_allclose(result['eeg'], signal * 31.25e-9)
+
+
+def test_decode24_numpy():
+    # The decoder reinterprets the packet as int32 with a stride of three
+    # bytes, which reads one byte of padding past the end. Make sure garbage in
+    # the padding (and in the neighboring byte in general) does not leak in.
+    rng = np.random.default_rng(3)
+    signal = rng.integers(-2**23, 2**23, size=(5, 12), dtype='int32')
+    signal[:, 0] = [-2**23, -1, 0, 1, 2**23-1]
+    signal[:, -1] = [2**23-1, 1, 0, -1, -2**23]
+    data = np.frombuffer(encode(signal) + b'\xff', dtype='uint8')
+    scratch = np.empty((12, 5), dtype='<i4')
+    actual = np.empty((5, 12), dtype='int32')
+    _decode24_numpy(data, actual, 5, 12, scratch)
+    np.testing.assert_array_equal(actual, signal)
+
+
+def test_decode24_numpy_matches_numba():
+    pytest.importorskip('numba')
+    from pyactivetwo.client import _decode24_numba
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=12 * 5 * 3 + 1, dtype='uint8')
+    scratch = np.empty((12, 5), dtype='<i4')
+    expected = np.empty((5, 12), dtype='int32')
+    actual = np.empty((5, 12), dtype='int32')
+    _decode24_numpy(data, expected, 5, 12, scratch)
+    _decode24_numba(data, actual, 5, 12, scratch)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_decode_trigger():
+    info = decode_trigger(0xAA0000 | 0x1234)
+    assert info.trigger == 0x1234
+    assert info.speed_mode == 0b1101
+    assert info.ActiveMK2
+    assert not info.new_epoch
+    assert not info.cms_in_range
+    assert not info.low_battery
+
+
+def test_decode_trigger_array():
+    rng = np.random.default_rng(2)
+    x = rng.integers(0, 2**24, size=100, dtype='int32')
+    result = decode_trigger_array(x)
+    for i, value in enumerate(x):
+        for name, expected in decode_trigger(value)._asdict().items():
+            assert result[name][i] == expected
+
+
+def test_decode24_numpy_matches_c():
+    pytest.importorskip('pyactivetwo._unpack24')
+    from pyactivetwo.client import _decode24_c
+    rng = np.random.default_rng(0)
+    # 7 channels x 13 samples leaves a tail for the scalar loop
+    data = rng.integers(0, 256, size=13 * 7 * 3 + 1, dtype='uint8')
+    scratch = np.empty((13, 7), dtype='<i4')
+    expected = np.empty((7, 13), dtype='int32')
+    actual = np.empty((7, 13), dtype='int32')
+    _decode24_numpy(data, expected, 7, 13, scratch)
+    _decode24_c(data, actual, 7, 13, scratch)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_read_receive_thread():
+    rng = np.random.default_rng(4)
+    signal = rng.integers(-2**23, 2**23, size=(3, 64), dtype='int32')
+    client = make_client(signal, max_chunk=11, eeg_channels=3, fs=512,
+                         receive_thread=True)
+    client._start_receiver()
+    try:
+        first = client.read(32 / 512)
+        second = client.read(32 / 512)
+    finally:
+        client._stop_receiver()
+    np.testing.assert_allclose(first['eeg'], signal[:, :32] * 31.25e-9)
+    np.testing.assert_allclose(second['eeg'], signal[:, 32:] * 31.25e-9)
+
+
+def test_read_copy():
+    signal = np.arange(3 * 16, dtype='int32').reshape((3, 16))
+    client = make_client(signal, eeg_channels=2, trigger_included=True, fs=256)
+    result = client.read(16 / 256)
+    assert result['eeg'].base is not None
+    client = make_client(signal, eeg_channels=2, trigger_included=True, fs=256)
+    result = client.read(16 / 256, copy=True)
+    assert result['eeg'].base is None
+    np.testing.assert_array_equal(result['trigger'], signal[-1])
+
+
+def test_read_tcp_samples():
+    rng = np.random.default_rng(5)
+    signal = rng.integers(-2**23, 2**23, size=(4, 96), dtype='int32')
+    client = make_client(signal, max_chunk=100, eeg_channels=4, fs=1024,
+                         tcp_samples=48)
+    assert client.buffer_size == 4 * 48 * 3
+    result = client.read(96 / 1024)
+    np.testing.assert_allclose(result['eeg'], signal * 31.25e-9)
+
+
+def test_read_connection_closed():
+    signal = np.zeros((2, 8), dtype='int32')
+    client = make_client(signal, eeg_channels=2, fs=256)
+    with pytest.raises(ConnectionError):
+        client.read(16 / 256)
+
+
+def test_read_receive_thread_slow_blocks():
+    # Each block takes longer to arrive than `socket_timeout`, but less than
+    # the time it takes ActiView to produce it.
+    rng = np.random.default_rng(6)
+    signal = rng.integers(-2**23, 2**23, size=(2, 64), dtype='int32')
+    client = ActiveTwoClient(eeg_channels=2, fs=256, tcp_samples=32,
+                             socket_timeout=0.05, receive_thread=True)
+    client.sock = SlowSocket(encode(signal), 2 * 32 * 3, 0.1)
+    client._start_receiver()
+    try:
+        result = client.read(64 / 256)
+    finally:
+        client._stop_receiver()
+    np.testing.assert_allclose(result['eeg'], signal * 31.25e-9)
+
+
+def test_read_timeout_mid_packet():
+    # A timeout partway through a packet ends the read, but the bytes already
+    # received must not be lost or the following reads will be misaligned.
+    signal = np.arange(2 * 32, dtype='int32').reshape((2, 32)) - 20
+    client = ActiveTwoClient(eeg_channels=2, fs=256)
+    packet_size = client.buffer_size
+    client.sock = StallingSocket(encode(signal), [packet_size + 10])
+    first = client.read(32 / 256)
+    assert first['eeg'].shape == (2, 2)
+    np.testing.assert_allclose(first['eeg'], signal[:, :2] * 31.25e-9)
+    second = client.read(30 / 256)
+    np.testing.assert_allclose(second['eeg'], signal[:, 2:] * 31.25e-9)
+
+
+def test_read_receive_thread_error_persists():
+    signal = np.zeros((2, 8), dtype='int32')
+    client = make_client(signal, eeg_channels=2, fs=256, receive_thread=True)
+    client._start_receiver()
+    try:
+        with pytest.raises(ConnectionError):
+            client.read(16 / 256)
+        with pytest.raises(ConnectionError):
+            client.read(16 / 256)
+    finally:
+        client._stop_receiver()
+
+
+def test_stop_receiver_without_socket_timeout():
+    # Enough data to fill both buffers, after which the receive thread waits
+    # for a free buffer. It must still notice the stop request.
+    signal = np.zeros((2, 64), dtype='int32')
+    client = make_client(signal, eeg_channels=2, fs=256, socket_timeout=None,
+                         receive_thread=True)
+    client._start_receiver()
+    time.sleep(0.1)
+    thread = client._thread
+    client._stop_receiver()
+    assert not thread.is_alive()
+
+
+def test_read_receive_thread_without_socket_timeout():
+    rng = np.random.default_rng(7)
+    signal = rng.integers(-2**23, 2**23, size=(2, 64), dtype='int32')
+    client = make_client(signal, eeg_channels=2, fs=256, socket_timeout=None,
+                         receive_thread=True)
+    client._start_receiver()
+    try:
+        result = client.read(64 / 256)
+    finally:
+        client._stop_receiver()
+    np.testing.assert_allclose(result['eeg'], signal * 31.25e-9)
+
+
+@pytest.mark.parametrize('tcp_samples', [0, -4, 1.5])
+def test_invalid_tcp_samples(tcp_samples):
+    with pytest.raises(ValueError):
+        ActiveTwoClient(tcp_samples=tcp_samples)